@@ -18,32 +18,164 @@
 """
 This module provides a super lightweight flask application that provides an
 easy interface to an Uploader for other processes
+
+Importing it is cheap: couchdbkit, habitat and couch_to_xml are only imported
+when first used, and the config only loaded by :func:`setup`, which runs
+before the first request. Under uwsgi (without lazy-apps) the module is
+imported by the master, so instead setup runs and the heavy modules are
+imported there, to be shared by every worker it forks. If ``warmup`` is set
+in the config, the allpayloads and receivers caches are filled there too.
+
+The warmed copies are kept (in :data:`warm`) after their cache entries
+expire, so that workers respawned after startup are not cold either: on a
+miss, a copy less than WARM_MAX_AGE old is served and rebuilt once the
+response has been sent.
 """
 
+import os
 import flask
 import base64
+import hmac
+import hashlib
+import functools
+import urllib
 import json
+import math
 import time
-import couchdbkit
+import logging
+import cStringIO
+import tempfile
+import threading
+import statsd
 from werkzeug.contrib.cache import SimpleCache as Cache
 from xml.sax.saxutils import escape as htmlescape
-from habitat import uploader
-from . import couch_to_xml
-from habitat.utils.startup import load_config, setup_logging
+from . import geo, journal, caches, ratelimit, thinning
+from . import instrumentation
+from .instrumentation import phase
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
 
 # Monkey patch float precision
 json.encoder.FLOAT_REPR = lambda o: format(o, '.5f')
 
 app = flask.Flask("habitat_transition.app")
+app.wsgi_app = instrumentation.TimingMiddleware(app.wsgi_app)
 cache = Cache(threshold=10, default_timeout=60)
-
-# Load config here :S ?
-# N.B.: Searches working directory since it won't be specified in argv.
-# Configure uwsgi appropriately.
-config = load_config()
-setup_logging(config, "transition_app")
-couch_settings = {"couch_uri": config["couch_uri"],
-                  "couch_db": config["couch_db"]}
+# (since, loaded): receivers_removed result. Clients poll with the tokens
+# handed out, so there are few distinct keys per load.
+tombstones = caches.LRUCache(threshold=100, default_timeout=0)
+# this worker's /admin/profile thread
+profiler = None
+profiler_lock = threading.Lock()
+
+# key: (time built, value). Filled in by warmup() in the uwsgi master, and
+# so inherited by every worker; see get_cached.
+warm = {}
+WARM_MAX_AGE = 10 * 60
+# key: when its refresh was scheduled
+refreshing = {}
+refreshing_lock = threading.Lock()
+
+INGEST_ENDPOINTS = \
+        set(["payload_telemetry", "listener_information", "listener_telemetry"])
+
+# Filled in by setup()
+config = None
+couch_settings = None
+shared_cache = None
+rate_limits = {}
+information_refresh = None
+track_thinner = None
+ingest_journal = None
+setup_lock = threading.Lock()
+
+@app.before_first_request
+def setup():
+    """Load the config and everything that depends on it, once"""
+    global config, couch_settings, shared_cache, information_refresh, \
+           track_thinner, ingest_journal
+
+    with setup_lock:
+        if config is not None:
+            return
+
+        from habitat.utils.startup import load_config, setup_logging
+
+        # N.B.: Searches working directory since it won't be specified in
+        # argv. Configure uwsgi appropriately.
+        new_config = load_config()
+        setup_logging(new_config, "transition_app")
+        settings = new_config["transition_app"]
+
+        couch_settings = {"couch_uri": new_config["couch_uri"],
+                          "couch_db": new_config["couch_db"]}
+        statsd.init_statsd({'STATSD_BUCKET_PREFIX': 'habitat.transition_app'})
+        shared_cache = caches.make_shared_cache(settings.get("shared_cache"))
+
+        if settings.get("rate_limit") and not settings.get("shared_cache"):
+            # Each worker would count separately, multiplying the limits
+            raise ValueError("rate_limit needs a shared_cache")
+
+        for (key, limit) in (settings.get("rate_limit") or {}).items():
+            assert key in ("address", "callsign")
+            rate_limits[key] = ratelimit.FixedWindow(
+                    shared_cache, "rl/" + key + "/",
+                    limit["limit"], limit["period"])
+
+        information_refresh = settings.get("information_refresh")
+
+        if settings.get("thinning"):
+            track_thinner = thinning.Thinner(cache=shared_cache,
+                                             **settings["thinning"])
+
+        if settings.get("journal"):
+            if not threads_enabled():
+                # The journal's threads would never run, and every ingest
+                # request would hang waiting for an fsync.
+                raise RuntimeError("the ingest journal needs uwsgi to be run "
+                                   "with enable-threads")
+
+            ingest_journal = journal.Journal(settings["journal"],
+                                             journal_upload)
+
+        config = new_config
+
+def threads_enabled():
+    """False if uwsgi won't run threads other than the request's"""
+    return uwsgi is None or bool(uwsgi.opt.get("enable-threads") or
+                                 uwsgi.opt.get("threads"))
+
+@app.before_request
+def note_endpoint():
+    # for TimingMiddleware
+    endpoint = flask.request.endpoint
+    flask.request.environ[instrumentation.ENDPOINT_KEY] = endpoint
+
+@app.before_request
+def admission_control():
+    """Reject over-eager clients before any JSON parsing or CouchDB work"""
+    if flask.request.endpoint not in INGEST_ENDPOINTS:
+        return
+
+    if "address" in rate_limits:
+        address = flask.request.remote_addr or ""
+        if not rate_limits["address"].allow(address):
+            statsd.increment("rate_limited.address")
+            return rate_limited()
+
+    if "callsign" in rate_limits:
+        callsign = flask.request.form.get("callsign", "").encode("utf8")
+        if not rate_limits["callsign"].allow(callsign):
+            statsd.increment("rate_limited.callsign")
+            return rate_limited()
+
+def rate_limited():
+    response = flask.make_response("Rate limited", 429)
+    response.headers["Retry-After"] = "1"
+    return response
 
 @app.route("/")
 def hello():
@@ -56,6 +188,12 @@ def hello():
 
     <h3>receivers list</h3>
     <p><a href="receivers">JSON</a></p>
+    <p>
+      Filter with <tt>?bbox=south,west,north,east</tt> or
+      <tt>?lat=..&amp;lon=..&amp;radius=..</tt> (radius in km).
+      Add <tt>?since=..</tt> with the <tt>since</tt> value of the previous
+      response to get only changed listeners and tombstones.
+    </p>
 
     <form action="payload_telemetry" method="POST">
     <h3>payload_telemetry</h3>
@@ -105,65 +243,173 @@ def get_time_created():
 
 @app.route("/payload_telemetry", methods=["POST"])
 def payload_telemetry():
-    callsign = flask.request.form["callsign"]
-    string = flask.request.form["string"]
-    string_type = flask.request.form["string_type"]
-    metadata = json.loads(flask.request.form["metadata"])
-    time_created = get_time_created()
+    with phase("parse"):
+        callsign = flask.request.form["callsign"]
+        string = flask.request.form["string"]
+        string_type = flask.request.form["string_type"]
+        metadata = json.loads(flask.request.form["metadata"])
+        time_created = get_time_created()
 
-    if string_type == "base64":
-        string = base64.b64decode(string)
-    elif string_type == "ascii" or string_type == "ascii-stripped":
-        string = string.encode("utf8")
+        if string_type == "base64":
+            string = base64.b64decode(string)
+        elif string_type == "ascii" or string_type == "ascii-stripped":
+            string = string.encode("utf8")
 
-    if string_type == "ascii-stripped":
-        string += "\n"
+        if string_type == "ascii-stripped":
+            string += "\n"
 
     assert callsign and string
     assert isinstance(metadata, dict)
 
-    u = uploader.Uploader(callsign=callsign, **couch_settings)
-    try:
-        u.payload_telemetry(string, metadata, time_created)
-    except uploader.UnmergeableError:
-        app.logger.warning("Unmergeable: %s (%r)", callsign, string)
+    submit("payload_telemetry", callsign, string, metadata, time_created)
 
     return "OK"
 
+def information_digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+def information_key(callsign):
+    return "li/" + urllib.quote(callsign.encode("utf8"), safe="")
+
 @app.route("/listener_information", methods=["POST"])
 def listener_information():
-    callsign = flask.request.form["callsign"]
-    data = json.loads(flask.request.form["data"])
-    time_created = get_time_created()
+    with phase("parse"):
+        callsign = flask.request.form["callsign"]
+        data = json.loads(flask.request.form["data"])
+        time_created = get_time_created()
 
     assert callsign and data
     assert isinstance(data, dict)
 
-    u = uploader.Uploader(callsign=callsign, **couch_settings)
-    u.listener_information(data, time_created)
+    if information_refresh:
+        digest = information_digest(data)
+        if shared_cache.get(information_key(callsign)) == digest:
+            # Same as the last doc we wrote, which is recent enough to keep
+            # the listener on the map.
+            statsd.increment("listener_information.suppressed")
+            return "OK"
+
+    submit("listener_information", callsign, data, time_created)
+
+    if information_refresh:
+        shared_cache.set(information_key(callsign), digest,
+                         timeout=information_refresh)
 
     return "OK"
 
+def thin_track(callsign, data, time_created):
+    """Returns True if this chase car position should be stored"""
+    if track_thinner is None or not data.get("chase", False):
+        return True
+
+    try:
+        lat = float(data["latitude"])
+        lon = float(data["longitude"])
+    except (KeyError, TypeError, ValueError):
+        return True
+
+    if time_created is None:
+        time_created = time.time()
+
+    return track_thinner.consider(callsign, lat, lon, time_created)
+
 @app.route("/listener_telemetry", methods=["POST"])
 def listener_telemetry():
-    callsign = flask.request.form["callsign"]
-    data = json.loads(flask.request.form["data"])
-    time_created = get_time_created()
+    with phase("parse"):
+        callsign = flask.request.form["callsign"]
+        data = json.loads(flask.request.form["data"])
+        time_created = get_time_created()
 
     assert callsign and data
     assert isinstance(data, dict)
 
-    u = uploader.Uploader(callsign=callsign, **couch_settings)
-    u.listener_telemetry(data, time_created)
+    if not thin_track(callsign, data, time_created):
+        statsd.increment("listener_telemetry.thinned")
+        return "OK"
+
+    submit("listener_telemetry", callsign, data, time_created)
 
     return "OK"
 
+def upload(kind, callsign, *args):
+    from habitat import uploader
+
+    u = uploader.Uploader(callsign=callsign, **couch_settings)
+
+    if kind == "payload_telemetry":
+        try:
+            u.payload_telemetry(*args)
+        except uploader.UnmergeableError:
+            app.logger.warning("Unmergeable: %s (%r)", callsign, args[0])
+    elif kind == "listener_information":
+        u.listener_information(*args)
+    elif kind == "listener_telemetry":
+        u.listener_telemetry(*args)
+    else:
+        raise ValueError("kind")
+
+def submit(kind, callsign, *args):
+    """Upload now, or via the journal if one is configured"""
+    if ingest_journal is None:
+        with phase("couch"):
+            upload(kind, callsign, *args)
+        return
+
+    args = list(args)
+    if kind == "payload_telemetry":
+        # the string may be binary
+        args[0] = base64.b64encode(args[0])
+    if args[-1] is None:
+        # time_created: Uploader would otherwise use the time it's drained
+        args[-1] = int(time.time())
+
+    with phase("journal"):
+        ingest_journal.append({"kind": kind, "callsign": callsign,
+                               "args": args})
+
+def journal_upload(entry):
+    args = entry["args"]
+    if entry["kind"] == "payload_telemetry":
+        args[0] = base64.b64decode(args[0])
+
+    try:
+        upload(entry["kind"], entry["callsign"], *args)
+    except Exception as e:
+        # Retrying a doc that CouchDB refused (e.g., failed validation)
+        # would block the journal forever.
+        status = getattr(e, "status_int", None)
+        if status is not None and 400 <= status < 500 and status != 409:
+            app.logger.exception("Dropping journalled %s from %s",
+                                 entry["kind"], entry["callsign"])
+        else:
+            raise
+
+def build_allpayloads():
+    """
+    Fetch and render the payloads, and cache the XML. tidy's output is read
+    in full and its exit status checked before a response is started, so a
+    failure is a 500 rather than a truncated body that clients and proxies
+    cache for a minute.
+    """
+    from . import couch_to_xml
+
+    with phase("couch"):
+        payloads = couch_to_xml.get_payloads(**couch_settings)
+    with phase("render"):
+        # The tree is dropped once tidy has it; buf is the only full copy
+        # until getvalue()
+        tidy = couch_to_xml.build_xml(payloads).start_tidy()
+        buf = cStringIO.StringIO()
+        for chunk in couch_to_xml.iter_tidy(tidy):
+            buf.write(chunk)
+
+    text = buf.getvalue()
+    cache.set('allpayloads', text)
+    return text
+
 @app.route("/allpayloads")
 def allpayloads():
-    text = cache.get('allpayloads')
-    if text is None:
-        text = couch_to_xml.dump_xml(**couch_settings)
-        cache.set('allpayloads', text)
+    text = get_cached('allpayloads', build_allpayloads)
     response = flask.make_response(text)
     set_expires(response, 60)
     return response
@@ -213,10 +459,18 @@ def listener_map(callsign, data):
     except KeyError:
         return None
 
-def receivers_load(couch_db):
+def receivers_load(couch_db, now=None, seen=None):
+    """
+    If *seen* is a dict, it is filled with the set of doc types each
+    callsign has in the window, including callsigns that are then discarded
+    """
+
     listeners = {}
 
-    yesterday = int(time.time() - (24 * 60 * 60))
+    if now is None:
+        now = time.time()
+
+    yesterday = int(now - (24 * 60 * 60))
     startkey = [yesterday, None]
     o = {"startkey": startkey}
 
@@ -227,12 +481,18 @@ def receivers_load(couch_db):
         for result in view:
             (time_uploaded, callsign) = result["key"]
 
+            if seen is not None:
+                seen.setdefault(callsign, set()).add(doc_type)
+
             l = {doc_type: result["id"], "latest": time_uploaded}
 
             if callsign not in listeners:
+                l["changed"] = time_uploaded
                 listeners[callsign] = l
             else:
                 listeners[callsign].update(l)
+                listeners[callsign]["changed"] = \
+                        max(listeners[callsign]["changed"], time_uploaded)
 
     required_ids = {}
     remove_listeners = []
@@ -265,20 +525,382 @@ def receivers_load(couch_db):
 
     return listeners
 
-@app.route("/receivers")
-def receivers():
+def get_couch_db():
+    import couchdbkit
+
     couch_server = couchdbkit.Server(couch_settings["couch_uri"])
-    couch_db = couch_server[couch_settings["couch_db"]]
+    return couch_server[couch_settings["couch_db"]]
 
-    listeners = receivers_load(couch_db)
+def listable(callsign, doc_types):
+    """Could receivers_load have listed a callsign with these docs?"""
+    return bool(callsign) and "chase" not in callsign and \
+           "information" in doc_types and "telemetry" in doc_types
 
-    response_data = []
-    for callsign in listeners:
-        l = listener_map(callsign, listeners[callsign])
-        if l is not None:
-            response_data.append(l)
+def receivers_grid():
+    """
+    Returns (loaded, grid, changed, seen) where loaded is the time the
+    listeners were fetched, changed maps callsign to the time_created of its
+    newest information or telemetry doc and seen is as for receivers_load
+    """
+
+    return get_cached('receivers', build_receivers_grid)
+
+def build_receivers_grid():
+    loaded = int(time.time())
+    seen = {}
+    with phase("couch"):
+        listeners = receivers_load(get_couch_db(), loaded, seen)
+
+    with phase("render"):
+        grid = geo.ListenerGrid()
+        changed = {}
+        for callsign in listeners:
+            l = listener_map(callsign, listeners[callsign])
+            if l is not None:
+                grid.add(l)
+                changed[callsign] = listeners[callsign]["changed"]
+
+    cached = (loaded, grid, changed, seen)
+    cache.set('receivers', cached)
+    return cached
+
+def receivers_removed(couch_db, since, loaded, current, seen):
+    """
+    Find callsigns that may have been in a receivers list built at *since*
+    but aren't in *current*, i.e., had a doc in the window that has since
+    scrolled out of the last 24 hours. *since* must not be after *loaded*.
+    """
+
+    if since >= loaded:
+        return []
+
+    o = {"startkey": [since - (24 * 60 * 60), None],
+         "endkey": [loaded - (24 * 60 * 60), None]}
+
+    window = {}
+    for doc_type in ["information", "telemetry"]:
+        view_name = "listener_{0}/time_created_callsign".format(doc_type)
+        for result in couch_db.view(view_name, **o):
+            (time_uploaded, callsign) = result["key"]
+            window.setdefault(callsign, set()).add(doc_type)
+
+    removed = []
+    for (callsign, doc_types) in window.items():
+        if callsign in current:
+            continue
+        # Skip callsigns that were never listed (chase cars, listeners with
+        # no information doc, ...)
+        if listable(callsign, doc_types | seen.get(callsign, set())):
+            removed.append(callsign)
+
+    return sorted(removed)
+
+def query_float(value):
+    """float(), rejecting NaN and infinities with a ValueError"""
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError(value)
+    return value
+
+def query_lat(value):
+    lat = query_float(value)
+    if not -90 <= lat <= 90:
+        raise ValueError(lat)
+    return lat
+
+def query_lon(value):
+    """Wrap into [-180, 180); maps send e.g. 190 after panning east"""
+    lon = math.fmod(query_float(value) + 180, 360)
+    if lon < 0:
+        lon += 360
+    return lon - 180
+
+def receivers_query(grid):
+    """
+    Returns an iterator over the listeners the query string asks for. Bad
+    queries are rejected here, before anything is streamed.
+    """
+
+    args = flask.request.args
 
-    response = flask.make_response(json.dumps(response_data))
-    set_expires(response, 10 * 60)
+    try:
+        if "bbox" in args:
+            (south, west, north, east) = args["bbox"].split(",")
+            (south, north) = (query_lat(south), query_lat(north))
+            (west, east) = (query_float(west), query_float(east))
+            if east - west >= 360:
+                (west, east) = (-180.0, 180.0)
+            else:
+                (west, east) = (query_lon(west), query_lon(east))
+            return grid.bbox(south, west, north, east)
+        elif "radius" in args:
+            lat = query_lat(args["lat"])
+            lon = query_lon(args["lon"])
+            radius = query_float(args["radius"]) * 1000
+            if radius < 0:
+                raise ValueError(radius)
+            return grid.radius(lat, lon, radius)
+        elif "lat" in args or "lon" in args:
+            # A viewport without a radius; don't silently return everything
+            flask.abort(400)
+    except (KeyError, ValueError):
+        flask.abort(400)
+
+    return iter(grid.items)
+
+def iter_json_list(items, chunk_size=8192):
+    """Serialise an iterable as a JSON list, yielding chunk_size-ish strs"""
+    buf = ["["]
+    length = 0
+    first = True
+    for item in items:
+        if not first:
+            buf.append(",")
+        first = False
+
+        s = json.dumps(item)
+        buf.append(s)
+        length += len(s)
+
+        if length >= chunk_size:
+            yield "".join(buf)
+            buf = []
+            length = 0
+    buf.append("]")
+    yield "".join(buf)
+
+def iter_json_object(header, key, items):
+    """Serialise header with an extra key holding the (streamed) list items"""
+    yield json.dumps(header)[:-1] + ', "{0}": '.format(key)
+    for chunk in iter_json_list(items):
+        yield chunk
+    yield "}"
+
+# time_created is set by the client (or on arrival), so a doc can be
+# written after a load that its time_created predates, through upload
+# latency or clock skew. The since token handed out is held back by this
+# much so that such docs are sent on the next poll; listeners changed in the
+# margin are sent twice, which is harmless.
+DELTA_MARGIN = 10 * 60
+
+def receivers_delta(since, loaded, grid, changed, seen):
+    """
+    Listeners changed after *since*, plus tombstones for those that have
+    aged out. *since* is compared against time_created.
+    """
+
+    # Tokens may come from a worker with a newer cache, or the future
+    since = min(since, loaded)
+    header = {"since": loaded - DELTA_MARGIN}
+
+    if since < loaded - (24 * 60 * 60):
+        # Too old to diff against; the client must replace its copy
+        header["reset"] = True
+        header["removed"] = []
+        listeners = receivers_query(grid)
+    else:
+        header["reset"] = False
+        removed = tombstones.get((since, loaded))
+        if removed is None:
+            with phase("couch"):
+                removed = receivers_removed(get_couch_db(), since, loaded,
+                                            changed, seen)
+            tombstones.set((since, loaded), removed)
+        header["removed"] = removed
+        listeners = (l for l in receivers_query(grid)
+                     if changed[l["name"]] > since)
+
+    return iter_json_object(header, "listeners", listeners)
+
+@app.route("/receivers")
+def receivers():
+    (loaded, grid, changed, seen) = receivers_grid()
+
+    if "since" in flask.request.args:
+        try:
+            since = int(query_float(flask.request.args["since"]))
+        except ValueError:
+            flask.abort(400)
+        body = receivers_delta(since, loaded, grid, changed, seen)
+        expires = 60
+    else:
+        body = iter_json_list(receivers_query(grid))
+        expires = 10 * 60
+
+    response = flask.Response(body)
+    set_expires(response, expires)
     response.headers["Content-type"] = "application/json"
     return response
+
+def profile_filename(pid):
+    return os.path.join(tempfile.gettempdir(),
+                        "habitat_transition-profile-{0}.folded".format(pid))
+
+@app.route("/admin/profile")
+def admin_profile():
+    """
+    Start sampling this worker's stacks for ?seconds= (default 10, at most
+    60) in a background thread, while the worker carries on serving
+    requests. Answers 202 with the worker's pid; afterwards, any worker on
+    the same host answers ?pid= with the profile, for flamegraph.pl (or 404
+    if it isn't ready).
+
+    Needs the admin_token config option, passed as ?token= or
+    X-Admin-Token, and answers 409 under uwsgi without enable-threads, as
+    the sampling thread would never run.
+    """
+
+    global profiler
+
+    expected = config["transition_app"].get("admin_token")
+    token = flask.request.headers.get("X-Admin-Token",
+                                      flask.request.args.get("token", ""))
+    if not expected or \
+            not hmac.compare_digest(token.encode("utf8"), str(expected)):
+        flask.abort(404)
+
+    args = flask.request.args
+
+    if "pid" in args:
+        try:
+            filename = profile_filename(int(args["pid"]))
+        except ValueError:
+            flask.abort(400)
+        try:
+            with open(filename) as f:
+                response = flask.make_response(f.read())
+        except IOError:
+            flask.abort(404)
+        response.headers["Content-type"] = "text/plain"
+        return response
+
+    try:
+        seconds = min(float(args.get("seconds", 10)), 60)
+        interval = max(float(args.get("interval", 0.005)), 0.001)
+    except ValueError:
+        flask.abort(400)
+
+    if not threads_enabled():
+        flask.abort(409)
+
+    filename = profile_filename(os.getpid())
+    with profiler_lock:
+        if profiler is not None and profiler.is_alive():
+            flask.abort(409)
+        # Don't let a fetch return the previous profile
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+        profiler = instrumentation.start_sampling(filename, seconds,
+                                                  interval)
+
+    response = flask.make_response(
+            "Sampling pid {0} for {1}s; then fetch ?pid={0}\n"
+            .format(os.getpid(), seconds), 202)
+    response.headers["Content-type"] = "text/plain"
+    return response
+
+def build_artifacts():
+    """Fetch and render what allpayloads and receivers serve"""
+    setup()
+    return (build_allpayloads(), build_receivers_grid())
+
+def warmup():
+    """
+    Fill the allpayloads and receivers caches.
+
+    The CouchDB work is done in a throwaway child process so that no
+    pooled connections are left open in this one to be inherited (and then
+    shared) by forked workers.
+    """
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(1)
+    try:
+        (allpayloads, receivers) = pool.apply(build_artifacts)
+    finally:
+        pool.close()
+        pool.join()
+
+    now = time.time()
+    warm['allpayloads'] = (now, allpayloads)
+    warm['receivers'] = (now, receivers)
+    cache.set('allpayloads', allpayloads)
+    cache.set('receivers', receivers)
+
+def get_cached(key, build):
+    """
+    Get *key* from the cache. On a miss, serve the warmed copy if there is a
+    recent enough one (see stale), or else call *build*, which should fill
+    the cache.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = stale(key, build)
+    if value is None:
+        value = build()
+        if key in warm:
+            warm[key] = (time.time(), value)
+    return value
+
+def stale(key, build):
+    """
+    Return the warmed copy of *key* if it is less than WARM_MAX_AGE old (or
+    else None) and arrange for *build* to refresh it and the cache after
+    this response has been sent.
+    """
+    if key not in warm:
+        return None
+
+    (built, value) = warm[key]
+    if built < time.time() - WARM_MAX_AGE:
+        return None
+
+    with refreshing_lock:
+        # Only one refresh at a time, unless one seems to have been lost
+        # (e.g. the request failed before it could be scheduled)
+        if refreshing.get(key, 0) < time.time() - 60:
+            refreshing[key] = time.time()
+            if not hasattr(flask.g, "refresh"):
+                flask.g.refresh = []
+            flask.g.refresh.append((key, build))
+
+    return value
+
+@app.after_request
+def schedule_refresh(response):
+    for (key, build) in getattr(flask.g, "refresh", ()):
+        response.call_on_close(functools.partial(refresh, key, build))
+    return response
+
+def refresh(key, build):
+    try:
+        warm[key] = (time.time(), build())
+    except:
+        logging.getLogger("habitat_transition.app") \
+                .exception("refreshing %s failed", key)
+    finally:
+        with refreshing_lock:
+            refreshing.pop(key, None)
+
+if uwsgi is not None:
+    setup()
+
+    # Imported here so that forked workers share them, rather than each
+    # importing them while answering its first requests. None of them opens
+    # any connections.
+    import couchdbkit
+    from habitat import uploader
+    from . import couch_to_xml
+
+    # With lazy-apps this runs in each worker as it starts, where warming
+    # up would only delay it and nothing would be shared.
+    lazy = uwsgi.opt.get("lazy-apps") or uwsgi.opt.get("lazy")
+    if config["transition_app"].get("warmup") and not lazy:
+        try:
+            warmup()
+        except:
+            logging.getLogger("habitat_transition.app") \
+                    .exception("warmup failed")
@@ -0,0 +1,127 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Construct the cache that the transition app shares between its workers from
+the ``shared_cache`` config section, e.g.::
+
+    shared_cache:
+        type: memcached
+        servers: ["127.0.0.1:11211"]
+
+``type`` may be ``memcached``, ``redis`` or ``uwsgi`` (a uwsgi ``--cache2``
+cache, named by ``name``). If the section is missing a per-process
+:class:`LRUCache` is used, so state is not shared between workers.
+
+memcached evicts least recently used items when full; use ``maxmemory-policy
+allkeys-lru`` with redis for the same behaviour.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from werkzeug.contrib import cache as wzcache
+
+__all__ = ["make_shared_cache", "LRUCache"]
+
+
+class LRUCache(wzcache.BaseCache):
+    """
+    An in-process cache holding at most *threshold* items, discarding the
+    least recently used when full. Safe to share between threads.
+    """
+
+    def __init__(self, threshold=10000, default_timeout=300):
+        wzcache.BaseCache.__init__(self, default_timeout)
+        self.threshold = threshold
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            (expires, value) = self._cache.pop(key)
+        except KeyError:
+            return None
+        if expires is not None and expires <= time.time():
+            return None
+        self._cache[key] = (expires, value)
+        return value
+
+    def _set(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else None
+
+        self._cache.pop(key, None)
+        self._cache[key] = (expires, value)
+        while len(self._cache) > self.threshold:
+            self._cache.popitem(last=False)
+        return True
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            return self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            return self._set(key, value, timeout)
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self._set(key, delta, 0)
+                return delta
+
+            # keep the existing expiry, as memcached and redis do
+            (expires, value) = self._cache[key]
+            self._cache[key] = (expires, value + delta)
+            return value + delta
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            return True
+
+
+def make_shared_cache(settings, key_prefix="habitat_transition/"):
+    if not settings:
+        return LRUCache(threshold=10000)
+
+    cache_type = settings["type"]
+
+    if cache_type == "memcached":
+        return wzcache.MemcachedCache(settings.get("servers"),
+                                      key_prefix=key_prefix)
+    elif cache_type == "redis":
+        return wzcache.RedisCache(settings.get("host", "localhost"),
+                                  settings.get("port", 6379),
+                                  key_prefix=key_prefix)
+    elif cache_type == "uwsgi":
+        return wzcache.UWSGICache(cache=settings.get("name", ""))
+    else:
+        raise ValueError("shared_cache type")
@@ -19,27 +19,65 @@
 """
 Connect to CouchDB, read in all the payload configs using payload_config \
 view, then output them as XML documents ready for dl-fldigi.
+
+With --publish, instead run forever, watching _changes for
+payload_configuration docs and (re)writing payloads.xml, and optionally
+payloads.json, into a directory along with gzipped copies, for a web server
+to serve as static files.
 """
 
+import os
 import sys
+import gzip
+import json
+import time
+import argparse
+import tempfile
+import threading
 import couchdbkit
 import subprocess
 import xml.etree.cElementTree as ET
 import xml.dom.minidom
+from couch_named_python import version
+from habitat.utils import immortal_changes
+
+@version(1)
+def payload_configuration_filter(doc, req):
+    """Select payload_configuration documents, and deletions."""
+    return doc.get('type') == "payload_configuration" or \
+           doc.get('_deleted', False)
 
 def main():
-    if len(sys.argv) != 3:
-        print >> sys.stderr, "Usage: {0} <couch uri> <couch db>".format(
-                sys.argv[0])
-        sys.exit(0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--publish", metavar="DIR",
+                        help="watch for changes and write files to DIR")
+    parser.add_argument("--json", action="store_true",
+                        help="with --publish, also write payloads.json")
+    parser.add_argument("couch_uri")
+    parser.add_argument("couch_db")
+    args = parser.parse_args()
+
+    if args.publish:
+        publish(args.couch_uri, args.couch_db, args.publish, args.json)
+        return
+
     try:
-        print dump_xml(sys.argv[1], sys.argv[2])
+        print dump_xml(args.couch_uri, args.couch_db)
     except Exception as e:
         print >> sys.stderr, "Error getting XML, stopping: {0}: {1}".format(
                 type(e), e)
 
 def dump_xml(couch_uri, couch_db):
-    payloads = get_payloads(couch_uri, couch_db)
+    return "".join(iter_xml(couch_uri, couch_db))
+
+def iter_xml(couch_uri, couch_db):
+    """Like dump_xml, but yields the tidied XML in chunks as it is produced"""
+    return payloads_xml(couch_uri, couch_db).iter_chunks()
+
+def payloads_xml(couch_uri, couch_db):
+    return build_xml(get_payloads(couch_uri, couch_db))
+
+def build_xml(payloads):
     root = PayloadsXML()
     for payload in sorted(payloads.keys(), key=lambda x: x.upper()):
         try:
@@ -49,7 +87,7 @@ def dump_xml(couch_uri, couch_db):
                 "{0}: {1}: {2}".format(payload, type(e), e)
             print >> sys.stderr, "Continuing..."
             continue
-    return str(root)
+    return root
 
 def get_payloads(couch_uri, couch_db):
     server = couchdbkit.Server(couch_uri)
@@ -71,6 +109,83 @@ def get_payloads(couch_uri, couch_db):
         payloads[callsign] = [doc["transmissions"], sentence]
     return payloads
 
+def publish(couch_uri, couch_db, directory, write_json=False, delay=5,
+            max_retry_delay=300):
+    """
+    Regenerate the files in *directory* now and whenever a payload
+    configuration changes. Bursts of changes within *delay* seconds are
+    rolled into one regeneration. Failures are retried with backoff rather
+    than waiting for the next change, which may be days away.
+    """
+
+    server = couchdbkit.Server(couch_uri)
+    db = server[couch_db]
+    changed = threading.Event()
+
+    def regenerate_thread():
+        retry_delay = delay
+        while True:
+            changed.wait()
+            time.sleep(delay)
+            changed.clear()
+            try:
+                write_files(couch_uri, couch_db, directory, write_json)
+                retry_delay = delay
+            except Exception as e:
+                print >> sys.stderr, "Error publishing, retrying in " \
+                    "{0}s: {1}: {2}".format(retry_delay, type(e), e)
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, max_retry_delay)
+                changed.set()
+
+    t = threading.Thread(target=regenerate_thread)
+    t.daemon = True
+    t.start()
+
+    update_seq = db.info()["update_seq"]
+    write_files(couch_uri, couch_db, directory, write_json)
+
+    consumer = immortal_changes.Consumer(db)
+    consumer.wait(lambda result: changed.set(),
+                  filter="couch_to_xml/payload_configuration",
+                  since=update_seq, heartbeat=1000)
+
+def write_files(couch_uri, couch_db, directory, write_json=False):
+    payloads = get_payloads(couch_uri, couch_db)
+    write_atomic(directory, "payloads.xml", str(build_xml(payloads)))
+
+    if write_json:
+        data = {}
+        for (callsign, (transmissions, sentence)) in payloads.items():
+            data[callsign] = {"transmissions": transmissions,
+                              "sentence": sentence}
+        write_atomic(directory, "payloads.json",
+                     json.dumps(data, sort_keys=True))
+
+def write_atomic(directory, filename, data):
+    """Write filename and filename.gz so readers never see partial files"""
+    for (name, compress) in ((filename + ".gz", True), (filename, False)):
+        f = tempfile.NamedTemporaryFile(dir=directory, prefix="." + name,
+                                        delete=False)
+        try:
+            if compress:
+                # mtime=0 keeps the output identical for identical input
+                gz = gzip.GzipFile(filename=filename, mode="wb", fileobj=f,
+                                   mtime=0)
+                gz.write(data)
+                gz.close()
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.chmod(f.name, 0644)
+            os.rename(f.name, os.path.join(directory, name))
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+
 class PayloadsXML(object):
     def __init__(self):
         self.tree = ET.Element("payloads")
@@ -80,14 +195,44 @@ class PayloadsXML(object):
         self.tree.append(payload.get_xml())
 
     def __str__(self):
+        return "".join(self.iter_chunks())
+
+    def iter_chunks(self, chunk_size=8192):
+        return iter_tidy(self.start_tidy(), chunk_size)
+
+    def start_tidy(self):
+        """
+        Feed the tree to tidy, returning the process to read the output
+        from. tidy parses all of its input before writing anything, so the
+        tree is no longer needed once this returns.
+        """
         p = subprocess.Popen(("tidy", "-xml", "-indent", "-quiet"),
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        root = ET.ElementTree(self.tree)
-        root.write(p.stdin, encoding="utf-8", xml_declaration=True)
-        p.stdin.close()
-        data = p.stdout.read()
-        p.wait()
-        return data
+        try:
+            root = ET.ElementTree(self.tree)
+            root.write(p.stdin, encoding="utf-8", xml_declaration=True)
+            p.stdin.close()
+        except:
+            p.stdout.close()
+            p.wait()
+            raise
+        return p
+
+def iter_tidy(p, chunk_size=8192):
+    """Yield the output of a tidy started by PayloadsXML.start_tidy"""
+    try:
+        while True:
+            data = p.stdout.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        p.stdout.close()
+        status = p.wait()
+
+    # 1 means warnings only
+    if status >= 2:
+        raise RuntimeError("tidy exited with status {0}".format(status))
 
 class PayloadXML(object):
     type_map = {
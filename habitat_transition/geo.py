@@ -0,0 +1,141 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A small in-memory lat/lon grid index, used to answer bounding box and radius
+queries over the receivers list without scanning every listener.
+"""
+
+import math
+
+__all__ = ["haversine", "ListenerGrid"]
+
+EARTH_RADIUS = 6371009.0 # metres
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance between two points, in metres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class ListenerGrid(object):
+    """
+    Buckets items (dicts with "lat" and "lon" keys, as produced by
+    :func:`habitat_transition.app.listener_map`) into square cells of
+    *cell_size* degrees.
+
+    Items without a usable position are kept in :attr:`items` but are never
+    returned by spatial queries.
+    """
+
+    def __init__(self, items=(), cell_size=1.0):
+        self.cell_size = float(cell_size)
+        self.items = []
+        self.cells = {}
+
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def add(self, item):
+        self.items.append(item)
+
+        try:
+            lat = float(item["lat"])
+            lon = float(item["lon"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return
+
+        self.cells.setdefault(self._cell(lat, lon), []).append(item)
+
+    def _candidates(self, south, west, north, east):
+        """Yield items in every cell that overlaps the box (no wrapping)"""
+        (row_min, col_min) = self._cell(south, west)
+        (row_max, col_max) = self._cell(north, east)
+        num_cells = (row_max - row_min + 1) * (col_max - col_min + 1)
+
+        if num_cells > len(self.cells):
+            # Cheaper to look at the occupied cells than to enumerate the box
+            for ((row, col), items) in self.cells.iteritems():
+                if row_min <= row <= row_max and col_min <= col <= col_max:
+                    for item in items:
+                        yield item
+        else:
+            for row in xrange(row_min, row_max + 1):
+                for col in xrange(col_min, col_max + 1):
+                    for item in self.cells.get((row, col), ()):
+                        yield item
+
+    def bbox(self, south, west, north, east):
+        """
+        Yield items inside the box. If *west* > *east* the box is taken to
+        cross the antimeridian.
+        """
+        south = max(-90.0, south)
+        north = min(90.0, north)
+
+        if south > north:
+            return
+
+        if west <= east:
+            ranges = [(west, east)]
+        else:
+            ranges = [(west, 180.0), (-180.0, east)]
+
+        for (w, e) in ranges:
+            for item in self._candidates(south, w, north, e):
+                lat = float(item["lat"])
+                lon = float(item["lon"])
+                if south <= lat <= north and w <= lon <= e:
+                    yield item
+
+    def radius(self, lat, lon, radius):
+        """Yield items within *radius* metres of (*lat*, *lon*)"""
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        south = lat - dlat
+        north = lat + dlat
+
+        if south <= -90 or north >= 90:
+            (west, east) = (-180.0, 180.0)
+        else:
+            dlon = dlat / math.cos(math.radians(max(abs(south), abs(north))))
+            if dlon >= 180:
+                (west, east) = (-180.0, 180.0)
+            else:
+                west = lon - dlon
+                east = lon + dlon
+                if west < -180:
+                    west += 360
+                if east > 180:
+                    east -= 360
+
+        for item in self.bbox(south, west, north, east):
+            if haversine(lat, lon, float(item["lat"]),
+                         float(item["lon"])) <= radius:
+                yield item
@@ -0,0 +1,177 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Request timing and sampling profiling for the transition app.
+
+:class:`TimingMiddleware` sends a statsd timer for each request's total time
+and for each phase recorded with :func:`phase` while handling it. Time spent
+iterating over a streamed response body, less any phases recorded inside it,
+is reported as the ``serialize`` phase.
+
+:func:`sample_stacks` periodically records the stack of every other thread in
+the process and returns the counts in the "folded" format understood by
+flamegraph.pl. :func:`start_sampling` runs it in a background thread, so that
+it sees the thread(s) serving requests meanwhile, and writes the result to a
+file.
+"""
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import thread
+import threading
+import statsd
+from collections import defaultdict
+from contextlib import contextmanager
+
+__all__ = ["phase", "TimingMiddleware", "sample_stacks", "start_sampling"]
+
+ENDPOINT_KEY = "habitat_transition.endpoint"
+
+_local = threading.local()
+
+
+@contextmanager
+def phase(name):
+    """Add the time taken by the with block to the current request's name"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases = getattr(_local, "phases", None)
+        if phases is not None:
+            phases[name] += time.time() - start
+
+
+class TimingMiddleware(object):
+    """
+    WSGI middleware; the app should put its name for the endpoint in
+    environ[ENDPOINT_KEY].
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        _local.phases = defaultdict(float)
+        start = time.time()
+        body = self.app(environ, start_response)
+        return _TimedBody(body, environ, start)
+
+
+class _TimedBody(object):
+    def __init__(self, body, environ, start):
+        self.body = body
+        self.environ = environ
+        self.start = start
+        self.serialize = 0.0
+
+    def __iter__(self):
+        phases = _local.phases
+        iterator = iter(self.body)
+
+        while True:
+            before = time.time()
+            recorded = sum(phases.values())
+
+            try:
+                chunk = next(iterator)
+            finally:
+                self.serialize += (time.time() - before) - \
+                                  (sum(phases.values()) - recorded)
+
+            yield chunk
+
+    def close(self):
+        # Report first: work done on close (e.g. Response.call_on_close)
+        # happens after the client has its response.
+        try:
+            self._report()
+        finally:
+            if hasattr(self.body, "close"):
+                self.body.close()
+
+    def _report(self):
+        phases = getattr(_local, "phases", {})
+        _local.phases = None
+
+        endpoint = self.environ.get(ENDPOINT_KEY) or "unknown"
+        total = time.time() - self.start
+
+        statsd.timing("{0}.total".format(endpoint), total * 1000)
+        if self.serialize:
+            phases["serialize"] += self.serialize
+        for (name, taken) in phases.items():
+            statsd.timing("{0}.{1}".format(endpoint, name), taken * 1000)
+
+
+def sample_stacks(duration, interval=0.005):
+    """
+    Sample the stacks of all other threads every *interval* seconds for
+    *duration* seconds, returning "frame;frame;frame count" lines.
+    """
+
+    me = thread.get_ident()
+    counts = defaultdict(int)
+    end = time.time() + duration
+
+    while time.time() < end:
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{0} ({1}:{2})".format(
+                    code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+
+            stack.reverse()
+            counts[";".join(stack)] += 1
+
+        time.sleep(interval)
+
+    return "".join("{0} {1}\n".format(stack, count)
+                   for (stack, count) in sorted(counts.items()))
+
+
+def start_sampling(filename, duration, interval=0.005):
+    """
+    Call :func:`sample_stacks` in a new daemon thread, writing its output to
+    *filename* (atomically, so it is either absent or complete) when done.
+    Returns the thread.
+    """
+
+    def run():
+        try:
+            folded = sample_stacks(duration, interval)
+            (fd, temp) = tempfile.mkstemp(dir=os.path.dirname(filename))
+            with os.fdopen(fd, "w") as f:
+                f.write(folded)
+            os.rename(temp, filename)
+        except:
+            logging.getLogger("habitat_transition.instrumentation") \
+                    .exception("sampling failed")
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return t
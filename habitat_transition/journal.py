@@ -0,0 +1,246 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A durable local journal of submissions, so that the transition app can
+acknowledge uploads without waiting for CouchDB.
+
+Each process appends JSON lines to its own ``journal-<pid>.log`` in the
+journal directory, holding an exclusive ``flock`` on it for as long as it
+lives. Appends are fsynced in batches: :meth:`Journal.append` returns once an
+fsync covering the entry has completed. A drainer thread then hands entries
+to the *submit* callable in order, retrying failures with backoff, and
+records how far it got in ``journal-<pid>.log.offset``.
+
+Every *orphan_check_interval* seconds another thread looks for files whose
+lock can be taken. These belong to a dead process, and are drained and
+removed by whichever process finds them first. Delivery is therefore
+at-least-once: an entry may be submitted again if a process dies between
+submitting it and recording the new offset.
+
+Without its background threads :meth:`Journal.append` would block forever,
+so the app refuses to start with a journal under uwsgi unless threads are
+enabled.
+"""
+
+import os
+import os.path
+import glob
+import fcntl
+import json
+import time
+import logging
+import threading
+
+__all__ = ["Journal"]
+logger = logging.getLogger("habitat_transition.journal")
+
+
+class Journal(object):
+    def __init__(self, directory, submit, fsync_interval=0.05,
+                 max_retry_delay=60, orphan_check_interval=60):
+        self.directory = directory
+        self.submit = submit
+        self.fsync_interval = fsync_interval
+        self.max_retry_delay = max_retry_delay
+        self.orphan_check_interval = orphan_check_interval
+
+        self.pid = None
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+
+    def _start(self):
+        """Open this process' journal and start its threads"""
+        self.pid = os.getpid()
+        self.filename = os.path.join(self.directory,
+                                     "journal-{0}.log".format(self.pid))
+        while True:
+            self.file = open(self.filename, "a+b")
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+            # Between the open and the flock, another process may have
+            # taken the file for an (empty) orphan and unlinked it. Anything
+            # written to that inode would never be drained.
+            try:
+                opened = os.fstat(self.file.fileno())
+                current = os.stat(self.filename)
+                if (opened.st_dev, opened.st_ino) == \
+                        (current.st_dev, current.st_ino):
+                    break
+            except OSError:
+                pass
+            self.file.close()
+
+        self.file.seek(0, os.SEEK_END)
+        self.written = self.file.tell()
+        self.synced = self.written
+        # bumped whenever the file is truncated, which resets the offsets
+        self.generation = 0
+
+        for target in (self._fsync_thread, self._drain_thread,
+                       self._orphan_thread):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def append(self, entry):
+        """Write entry to the journal and block until it is on disk"""
+        line = json.dumps(entry) + "\n"
+
+        with self.cond:
+            if self.pid != os.getpid():
+                # First use in this (possibly freshly forked) process
+                self._start()
+
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(line)
+            self.file.flush()
+            self.written += len(line)
+            end = self.written
+            generation = self.generation
+            self.cond.notify_all()
+
+            # If the drainer truncated the file, our entry was synced (and
+            # drained) before it did so.
+            while self.synced < end and self.generation == generation:
+                self.cond.wait()
+
+    def _fsync_thread(self):
+        while True:
+            try:
+                time.sleep(self.fsync_interval)
+
+                with self.cond:
+                    if self.synced == self.written:
+                        continue
+                    end = self.written
+
+                os.fsync(self.file.fileno())
+
+                with self.cond:
+                    self.synced = end
+                    self.cond.notify_all()
+            except:
+                logger.exception("fsync thread: confused")
+
+    def _drain_thread(self):
+        while True:
+            try:
+                self._drain_own()
+            except:
+                logger.exception("drain thread: confused")
+                time.sleep(1)
+
+    def _orphan_thread(self):
+        while True:
+            try:
+                self._drain_orphans()
+            except:
+                logger.exception("orphan thread: confused")
+            time.sleep(self.orphan_check_interval)
+
+    def _drain_own(self):
+        """Drain our own journal, forever"""
+        offset = self._read_offset(self.filename)
+
+        while True:
+            with self.cond:
+                if offset == self.synced == self.written and offset > 0:
+                    # Caught up: start the file afresh rather than growing
+                    # it forever.
+                    self.file.truncate(0)
+                    self.written = self.synced = offset = 0
+                    self.generation += 1
+                    self.cond.notify_all()
+                    self._write_offset(self.filename, 0)
+
+                while offset == self.synced:
+                    self.cond.wait()
+
+                end = self.synced
+
+            with open(self.filename, "rb") as f:
+                f.seek(offset)
+                data = f.read(end - offset)
+
+            for line in data.splitlines(True):
+                self._submit_line(line)
+                offset += len(line)
+                self._write_offset(self.filename, offset)
+
+    def _drain_orphans(self):
+        pattern = os.path.join(self.directory, "journal-*.log")
+        for filename in sorted(glob.glob(pattern)):
+            if filename == self.filename:
+                continue
+
+            try:
+                f = open(filename, "rb")
+            except IOError:
+                continue
+
+            try:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue # still alive
+
+                if not os.path.exists(filename):
+                    continue # someone else already finished it
+
+                logger.info("Replaying orphaned journal %s", filename)
+                offset = self._read_offset(filename)
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Torn write: was never acknowledged
+                        break
+                    self._submit_line(line)
+                    offset += len(line)
+                    self._write_offset(filename, offset)
+
+                os.unlink(filename)
+                try:
+                    os.unlink(filename + ".offset")
+                except OSError:
+                    pass
+            finally:
+                f.close()
+
+    def _submit_line(self, line):
+        entry = json.loads(line)
+        delay = min(1, self.max_retry_delay)
+
+        while True:
+            try:
+                self.submit(entry)
+                return
+            except:
+                logger.exception("submit failed; retrying in %ss", delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _read_offset(self, filename):
+        try:
+            with open(filename + ".offset", "rb") as f:
+                return int(f.read() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_offset(self, filename, offset):
+        with open(filename + ".offset", "wb") as f:
+            f.write(str(offset))
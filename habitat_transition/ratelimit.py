@@ -0,0 +1,60 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fixed window rate limiting, with the counters kept in a (werkzeug) cache so
+that they may be shared between uwsgi workers.
+"""
+
+import time
+import urllib
+
+__all__ = ["FixedWindow"]
+
+
+class FixedWindow(object):
+    """
+    Allows *limit* requests per key in each *period* second window.
+
+    Counters are created with the cache's ``add`` and bumped with its
+    ``inc``, which memcached and redis do atomically, so racing workers
+    cannot lose each other's requests. (uwsgi's cache falls back to get and
+    set.)
+    A client may get up to twice *limit* through around a window boundary.
+    """
+
+    def __init__(self, cache, prefix, limit, period):
+        self.cache = cache
+        self.prefix = prefix
+        self.limit = int(limit)
+        self.period = int(period)
+
+    def allow(self, key, now=None):
+        if now is None:
+            now = time.time()
+
+        window = int(now // self.period)
+        # memcached keys may not contain spaces or control characters
+        cache_key = "{0}{1}/{2}".format(self.prefix,
+                                        urllib.quote(key, safe=""), window)
+
+        # add does nothing if another worker created the counter first
+        self.cache.add(cache_key, 0, timeout=self.period + 1)
+        count = self.cache.inc(cache_key)
+
+        # If the cache is unavailable, let the request through
+        return count is None or count <= self.limit
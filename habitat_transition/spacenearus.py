@@ -17,9 +17,32 @@
 
 """
 A daemon that uploads parsed telemetry data to the spacenear.us tracker
+
+It may forward to several copies of the tracker at once, listed under
+``trackers`` in the daemon's config section::
+
+    trackers:
+        - "http://habhub.org/tracker/track.php?{0}"
+        - url: "http://example.com/tracker/track.php?{0}"
+          name: example
+          threads: 2
+          queue_size: 1000
+          timeout: 10
+
+Each tracker gets its own queue and uploader threads, so a slow or broken
+mirror only drops its own uploads. Names (used for statsd counters) default
+to the URL's host and path, and must be unique. A single ``tracker`` URL is
+still accepted.
+
+Setting ``debounce`` to a number of seconds collapses the revisions of a
+payload_telemetry doc (one per receiver merged in) that arrive within that
+window of its first, so only the final set of receivers is processed. With
+``debounce_first_immediately``, the revision that opens the window is
+processed straight away so the first receiver isn't delayed.
 """
 
 from urllib import urlencode
+from urlparse import urlparse
 from urllib2 import urlopen
 import requests
 import logging
@@ -27,14 +50,16 @@ import couchdbkit
 import traceback
 import threading
 import Queue
+import re
 import copy
 import json
 import time
 import statsd
 from couch_named_python import version
 from habitat.utils import rfc3339, immortal_changes
+from .thinning import Thinner
 
-__all__ = ["SpaceNearUs"]
+__all__ = ["SpaceNearUs", "TrackerSink"]
 logger = logging.getLogger("habitat_transition.spacenearus")
 statsd.init_statsd({'STATSD_BUCKET_PREFIX': 'habitat.spacenearus'})
 
@@ -52,31 +77,133 @@ def spacenear_filter(doc, req):
     return False
 
 
+class TrackerSink(object):
+    """
+    A tracker to forward to, with its own bounded queue and uploader
+    threads. When the queue is full, new uploads for this tracker are
+    dropped (and counted) rather than holding up the others.
+    """
+
+    def __init__(self, url, name=None, threads=5, queue_size=10000,
+                 timeout=30):
+        if name is None:
+            # Host and path, so that mirrors on one host get different names
+            parsed = urlparse(url)
+            name = re.sub("[^A-Za-z0-9]+", "_",
+                          parsed.netloc + parsed.path).strip("_")
+
+        self.url = url
+        self.name = name
+        self.threads = threads
+        self.timeout = timeout
+        self.upload_queue = Queue.Queue(queue_size)
+
+    def start(self):
+        for i in xrange(self.threads):
+            t = threading.Thread(target=self.uploader_thread)
+            t.daemon = True
+            t.start()
+
+    def put(self, params):
+        try:
+            self.upload_queue.put_nowait(params)
+        except Queue.Full:
+            logger.warning("Queue for %s full; dropping upload", self.name)
+            statsd.increment("dropped_uploads." + self.name)
+
+    def uploader_thread(self):
+        while True:
+            # Do not die, whatever happens. Dying is bad.
+            try:
+                params = self.upload_queue.get()
+                try:
+                    self._post_to_track(params)
+                except:
+                    logger.exception("exception during upload to %s",
+                                     self.name)
+                self.upload_queue.task_done()
+                n = str(self.upload_queue.qsize())
+                logger.debug("Queue length for " + self.name + " now: " + n)
+            except:
+                # Absolutely under no circumstance allow the thread to die
+                try:
+                    logger.exception("uploader thread: confused")
+                except:
+                    pass
+
+    def _post_to_track(self, params):
+        qs = urlencode(params, True)
+        url = self.url.format(qs)
+        logger.debug("encoded data: " + qs)
+        logger.debug("posting to URL: " + url)
+        try:
+            r = requests.get(url, timeout=self.timeout)
+        except requests.exceptions.HTTPError:
+            logger.exception("exception whilst opening %s", url)
+
+
 class SpaceNearUs:
     """
     The SpaceNearUs daemon forwards on parsed telemetry to the spacenear.us
-    tracker (or a copy of it) to use as an alternative frontend.
+    tracker (or copies of it) to use as an alternative frontend.
     """
 
     def __init__(self, config, daemon_name):
-        self.tracker = config[daemon_name]["tracker"]
+        daemon_config = config[daemon_name]
+        trackers = daemon_config.get("trackers") or \
+                   [daemon_config["tracker"]]
+
+        self.sinks = []
+        for tracker in trackers:
+            if isinstance(tracker, basestring):
+                tracker = {"url": tracker}
+            self.sinks.append(TrackerSink(**tracker))
+
+        names = [sink.name for sink in self.sinks]
+        if len(set(names)) != len(names):
+            # They would share statsd counters
+            raise ValueError("tracker names must be unique: " + str(names))
+
         server = couchdbkit.Server(config["couch_uri"])
         self.db = server[config["couch_db"]]
 
         self.recent_doc_ids = []
         self.recent_doc_receivers = {}
 
-        self.upload_queue = Queue.Queue()
         self.recent_lock = threading.RLock()
 
+        thinning = config[daemon_name].get("thinning")
+        if thinning:
+            thinning = dict(thinning)
+            self.quiet_period = thinning.pop("quiet_period", 30)
+            self.thinner = Thinner(**thinning)
+        else:
+            self.thinner = None
+        self.thin_pending = {}
+        self.thin_lock = threading.Lock()
+
+        self.debounce = daemon_config.get("debounce")
+        self.debounce_first = \
+                daemon_config.get("debounce_first_immediately", False)
+        self.debounce_pending = {}
+        self.debounce_lock = threading.Lock()
+
     def run(self):
         """
         Start a continuous connection to CouchDB's _changes feed, watching for
         new unparsed telemetry.
         """
 
-        for i in xrange(5):
-            t = threading.Thread(target=self.uploader_thread)
+        for sink in self.sinks:
+            sink.start()
+
+        if self.thinner is not None:
+            t = threading.Thread(target=self.thin_flush_thread)
+            t.daemon = True
+            t.start()
+
+        if self.debounce:
+            t = threading.Thread(target=self.debounce_flush_thread)
             t.daemon = True
             t.start()
 
@@ -97,12 +224,17 @@ class SpaceNearUs:
         logger.debug("Considering doc " + doc_id)
 
         if doc["type"] == "payload_telemetry":
-            num = self.payload_telemetry(doc)
+            if self.debounce:
+                num = self._debounce(doc)
+            else:
+                num = self.payload_telemetry(doc)
         elif doc["type"] == "listener_telemetry":
             num = self.listener_telemetry(doc)
 
         logger.debug("Added to queue: " + str(num))
-        logger.debug("Queue length now: " + str(self.upload_queue.qsize()))
+        for sink in self.sinks:
+            n = str(sink.upload_queue.qsize())
+            logger.debug("Queue length for " + sink.name + " now: " + n)
 
     def payload_telemetry(self, doc):
         required = {
@@ -178,11 +310,67 @@ class SpaceNearUs:
         for callsign in new_receivers:
             p = copy.deepcopy(params)
             p["callsign"] = callsign
-            self.upload_queue.put(p)
+            self._queue_upload(p)
 
         statsd.increment("good_uploads", len(new_receivers))
         return len(new_receivers)
 
+    def _debounce(self, doc):
+        """
+        Hold a payload_telemetry revision until its window closes, replacing
+        any earlier revision of the same doc that is already waiting.
+        """
+
+        doc_id = doc["_id"]
+
+        with self.debounce_lock:
+            if doc_id in self.debounce_pending:
+                deadline = self.debounce_pending[doc_id][0]
+                self.debounce_pending[doc_id] = (deadline, doc)
+                statsd.increment("debounced")
+                return 0
+
+            with self.recent_lock:
+                first = doc_id not in self.recent_doc_receivers
+            immediate = first and self.debounce_first
+
+            deadline = time.time() + self.debounce
+            # None: nothing newer than what was processed immediately
+            self.debounce_pending[doc_id] = \
+                    (deadline, None if immediate else doc)
+
+        if immediate:
+            return self.payload_telemetry(doc)
+        else:
+            return 0
+
+    def debounce_flush_thread(self):
+        while True:
+            # Do not die, as with uploader_thread
+            try:
+                time.sleep(min(self.debounce / 4.0, 0.25))
+                self._debounce_flush(time.time())
+            except:
+                try:
+                    logger.exception("debounce flush thread: confused")
+                except:
+                    pass
+
+    def _debounce_flush(self, now):
+        """Process the docs whose windows have closed by *now*"""
+        with self.debounce_lock:
+            due = [(doc_id, doc) for (doc_id, (deadline, doc))
+                   in self.debounce_pending.items()
+                   if deadline <= now]
+            for (doc_id, doc) in due:
+                del self.debounce_pending[doc_id]
+
+        for (doc_id, doc) in due:
+            if doc is not None:
+                num = self.payload_telemetry(doc)
+                logger.debug("Debounced " + doc_id + ", added to "
+                             "queue: " + str(num))
+
     def listener_telemetry(self, doc):
         fields = {
             "vehicle": "callsign",
@@ -214,28 +402,64 @@ class SpaceNearUs:
         params["time"] = timestr
 
         params["pass"] = "aurora"
-        self.upload_queue.put(params)
+
+        if self.thinner is not None and not self._thin(params, created):
+            statsd.increment("thinned")
+            return 0
+
+        self._queue_upload(params)
         return 1
 
-    def uploader_thread(self):
+    def _thin(self, params, created):
+        """
+        Decide whether to upload a chase car position now. If not, it's
+        held back, and uploaded by the flush thread if nothing newer
+        arrives for quiet_period seconds.
+        """
+
+        try:
+            callsign = params["vehicle"]
+            lat = float(params["lat"])
+            lon = float(params["lon"])
+        except (KeyError, TypeError, ValueError):
+            return True
+
+        with self.thin_lock:
+            if self.thinner.consider(callsign, lat, lon, created):
+                self.thin_pending.pop(callsign, None)
+                return True
+
+            self.thin_pending[callsign] = \
+                    (params, lat, lon, created, time.time())
+            return False
+
+    def thin_flush_thread(self):
         while True:
-            # Do not die, whatever happens. Dying is bad.
+            # Do not die, as with uploader_thread
             try:
-                params = self.upload_queue.get()
-                try:
-                    self._post_to_track(params)
-                except:
-                    logger.exception("exception during upload")
-                self.upload_queue.task_done()
-                n = str(self.upload_queue.qsize())
-                logger.debug("Queue length now: " + n)
+                time.sleep(1)
+                now = time.time()
+
+                with self.thin_lock:
+                    for callsign in self.thin_pending.keys():
+                        (params, lat, lon, created, arrived) = \
+                                self.thin_pending[callsign]
+                        if now - arrived < self.quiet_period:
+                            continue
+
+                        del self.thin_pending[callsign]
+                        self.thinner.keep(callsign, lat, lon, created)
+                        self._queue_upload(params)
             except:
-                # Absolutely under no circumstance allow the thread to die
                 try:
-                    logger.exception("uploader thread: confused")
+                    logger.exception("thin flush thread: confused")
                 except:
                     pass
 
+    def _queue_upload(self, params):
+        for sink in self.sinks:
+            sink.put(params)
+
     def _copy_fields(self, fields, data, params):
         for (tgt, src) in fields.items():
             try:
@@ -243,16 +467,6 @@ class SpaceNearUs:
             except KeyError:
                 continue
 
-    def _post_to_track(self, params):
-        qs = urlencode(params, True)
-        url = self.tracker.format(qs)
-        logger.debug("encoded data: " + qs)
-        logger.debug("posting to URL: " + url)
-        try:
-            r = requests.get(url)
-        except requests.exceptions.HTTPError:
-            logger.exception("exception whilst opening %s", url)
-
     def _all_floats_to_str(self, obj):
         if isinstance(obj, dict) or isinstance(obj, list):
             # Modify object in place then return it
@@ -0,0 +1,67 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the in-process LRU cache
+"""
+
+import threading
+
+from . import caches
+
+def test_lru_eviction():
+    cache = caches.LRUCache(threshold=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1 # a is now most recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_lru_timeout():
+    cache = caches.LRUCache()
+    cache.set("a", 1, timeout=-1)
+    assert cache.get("a") is None
+    assert cache.add("a", 2)
+    assert not cache.add("a", 3)
+    assert cache.get("a") == 2
+
+def test_lru_inc():
+    cache = caches.LRUCache()
+    assert cache.inc("a") == 1
+    cache.add("b", 0, timeout=-1)
+    assert cache.inc("b", 5) == 5
+    cache.add("c", 10)
+    assert cache.inc("c") == 11
+
+def test_lru_threads():
+    cache = caches.LRUCache(threshold=50)
+
+    def worker(n):
+        for i in range(1000):
+            cache.set((n, i), i)
+            cache.get((n, i - 1))
+            cache.inc("count")
+
+    threads = [threading.Thread(target=worker, args=(n, )) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert cache.get("count") == 4000
@@ -0,0 +1,109 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the couch_to_xml publisher's file writing
+"""
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+
+from . import couch_to_xml
+
+class TestPublish(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def read_gz(self, name):
+        f = gzip.open(os.path.join(self.directory, name), "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_write_atomic(self):
+        couch_to_xml.write_atomic(self.directory, "payloads.xml", "<a/>")
+
+        assert sorted(os.listdir(self.directory)) == \
+                ["payloads.xml", "payloads.xml.gz"]
+        assert self.read("payloads.xml") == "<a/>"
+        assert self.read_gz("payloads.xml.gz") == "<a/>"
+
+        # identical input gives identical files
+        gz = self.read("payloads.xml.gz")
+        couch_to_xml.write_atomic(self.directory, "payloads.xml", "<a/>")
+        assert self.read("payloads.xml.gz") == gz
+
+    def test_write_atomic_error(self):
+        couch_to_xml.write_atomic(self.directory, "payloads.xml", "<a/>")
+
+        try:
+            # can't be encoded, so fails part way through writing
+            couch_to_xml.write_atomic(self.directory, "payloads.xml",
+                                      u"<\u2603/>")
+        except UnicodeError:
+            pass
+        else:
+            raise AssertionError("expected UnicodeError")
+
+        # no temporary files left behind, and the old files are intact
+        assert sorted(os.listdir(self.directory)) == \
+                ["payloads.xml", "payloads.xml.gz"]
+        assert self.read("payloads.xml") == "<a/>"
+        assert self.read_gz("payloads.xml.gz") == "<a/>"
+
+    def test_write_files(self):
+        payloads = {"TEST": [[{"frequency": 434075000}], {"callsign": "TEST"}]}
+        built = []
+
+        class FakeXML(object):
+            def __str__(self):
+                return "<payloads/>"
+
+        def build_xml(p):
+            built.append(p)
+            return FakeXML()
+
+        (get_payloads, build_xml_) = \
+                (couch_to_xml.get_payloads, couch_to_xml.build_xml)
+        couch_to_xml.get_payloads = lambda uri, db: payloads
+        couch_to_xml.build_xml = build_xml
+        try:
+            couch_to_xml.write_files("http://localhost:5984", "habitat",
+                                     self.directory, write_json=True)
+        finally:
+            couch_to_xml.get_payloads = get_payloads
+            couch_to_xml.build_xml = build_xml_
+
+        assert built == [payloads]
+        assert self.read("payloads.xml") == "<payloads/>"
+        assert self.read_gz("payloads.xml.gz") == "<payloads/>"
+
+        expect = {"TEST": {"transmissions": [{"frequency": 434075000}],
+                           "sentence": {"callsign": "TEST"}}}
+        assert json.loads(self.read("payloads.json")) == expect
+        assert json.loads(self.read_gz("payloads.json.gz")) == expect
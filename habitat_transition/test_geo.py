@@ -0,0 +1,55 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the receivers grid index
+"""
+
+from . import geo
+
+listeners = [
+    {"name": "CAMBRIDGE", "lat": 52.2, "lon": 0.12},
+    {"name": "LONDON", "lat": 51.5, "lon": -0.13},
+    {"name": "FIJI", "lat": -17.7, "lon": 178.1},
+    {"name": "SAMOA", "lat": -13.8, "lon": -172.1},
+    {"name": "NOWHERE", "lat": "garbage", "lon": None}
+]
+
+def names(items):
+    return sorted(item["name"] for item in items)
+
+def test_haversine():
+    d = geo.haversine(52.2, 0.12, 51.5, -0.13)
+    assert 79000 < d < 80000
+
+def test_bbox():
+    grid = geo.ListenerGrid(listeners, cell_size=0.5)
+    assert len(grid) == 5
+    assert names(grid.bbox(52, 0, 53, 1)) == ["CAMBRIDGE"]
+    assert names(grid.bbox(50, -1, 53, 1)) == ["CAMBRIDGE", "LONDON"]
+    assert names(grid.bbox(-90, -180, 90, 180)) == \
+            ["CAMBRIDGE", "FIJI", "LONDON", "SAMOA"]
+
+def test_bbox_antimeridian():
+    grid = geo.ListenerGrid(listeners)
+    assert names(grid.bbox(-20, 170, -10, -170)) == ["FIJI", "SAMOA"]
+
+def test_radius():
+    grid = geo.ListenerGrid(listeners, cell_size=0.1)
+    assert names(grid.radius(52.0, 0.0, 50000)) == ["CAMBRIDGE"]
+    assert names(grid.radius(52.0, 0.0, 100000)) == ["CAMBRIDGE", "LONDON"]
+    assert names(grid.radius(-15.0, 179.9, 1000000)) == ["FIJI", "SAMOA"]
@@ -0,0 +1,132 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests request timing and stack sampling
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from . import instrumentation
+from .instrumentation import phase
+
+class FakeStatsd(object):
+    def __init__(self):
+        self.timings = {}
+    def timing(self, name, value):
+        self.timings[name] = value
+
+class TestTimingMiddleware(object):
+    def setup(self):
+        self.statsd = instrumentation.statsd
+        instrumentation.statsd = FakeStatsd()
+
+    def teardown(self):
+        instrumentation.statsd = self.statsd
+
+    def test_phase_outside_request(self):
+        instrumentation._local.phases = None
+        with phase("couch"):
+            pass
+
+    def test_phases(self):
+        events = []
+
+        def body():
+            with phase("couch"):
+                time.sleep(0.05)
+            yield "a"
+            time.sleep(0.01)
+            yield "b"
+
+        class Body(object):
+            def __iter__(self):
+                return body()
+            def close(self):
+                # report before anything done on close
+                events.append(sorted(instrumentation.statsd.timings))
+
+        def app(environ, start_response):
+            environ[instrumentation.ENDPOINT_KEY] = "test"
+            with phase("parse"):
+                time.sleep(0.01)
+            return Body()
+
+        middleware = instrumentation.TimingMiddleware(app)
+        response = middleware({}, None)
+        assert "".join(response) == "ab"
+        response.close()
+
+        timings = instrumentation.statsd.timings
+        assert events == [["test.couch", "test.parse", "test.serialize",
+                           "test.total"]]
+        assert timings["test.parse"] >= 10
+        assert timings["test.couch"] >= 50
+        # serialize excludes the couch phase inside the body
+        assert 10 <= timings["test.serialize"] < 50
+        assert timings["test.total"] >= 70
+
+    def test_unknown_endpoint(self):
+        middleware = instrumentation.TimingMiddleware(lambda e, s: ["x"])
+        middleware({}, None).close()
+        assert instrumentation.statsd.timings.keys() == ["unknown.total"]
+
+def busy_for_sampling(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+def run_busy():
+    stop = threading.Event()
+    t = threading.Thread(target=busy_for_sampling, args=(stop, ))
+    t.daemon = True
+    t.start()
+    return stop
+
+def test_sample_stacks():
+    stop = run_busy()
+    try:
+        folded = instrumentation.sample_stacks(0.05, 0.005)
+    finally:
+        stop.set()
+
+    lines = folded.splitlines()
+    assert lines
+    stacks = [line.rsplit(" ", 1) for line in lines]
+    assert any("busy_for_sampling" in stack for (stack, count) in stacks)
+    assert all(int(count) > 0 for (stack, count) in stacks)
+    # not itself
+    assert not any("test_sample_stacks" in stack for (stack, count) in stacks)
+
+def test_start_sampling():
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "profile.folded")
+    try:
+        # the thread that asked is sampled
+        t = instrumentation.start_sampling(filename, 0.05, 0.005)
+        time.sleep(0.01)
+        assert not os.path.exists(filename)
+        t.join()
+
+        with open(filename) as f:
+            assert "test_start_sampling" in f.read()
+        assert os.listdir(directory) == ["profile.folded"]
+    finally:
+        shutil.rmtree(directory)
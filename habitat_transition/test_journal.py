@@ -0,0 +1,152 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the ingest journal
+"""
+
+import os
+import os.path
+import time
+import shutil
+import tempfile
+
+from . import journal
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+class TestJournal(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.submitted = []
+
+    def teardown(self):
+        # The journal's threads run until the process exits, and may still
+        # be touching the offset files.
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def make_journal(self, **kwargs):
+        kwargs.setdefault("fsync_interval", 0.01)
+        kwargs.setdefault("orphan_check_interval", 0.05)
+        return journal.Journal(self.directory, self.submitted.append,
+                               **kwargs)
+
+    def write_orphan(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def test_append_drain_order(self):
+        j = self.make_journal()
+        for i in range(20):
+            j.append({"n": i})
+
+        wait_for(lambda: len(self.submitted) == 20)
+        assert self.submitted == [{"n": i} for i in range(20)]
+
+    def test_truncate_and_reset(self):
+        j = self.make_journal()
+        j.append({"n": 1})
+        wait_for(lambda: os.path.getsize(j.filename) == 0)
+        with open(j.filename + ".offset") as f:
+            assert f.read() == "0"
+
+        # and carries on working afterwards
+        j.append({"n": 2})
+        wait_for(lambda: len(self.submitted) == 2)
+        assert self.submitted == [{"n": 1}, {"n": 2}]
+
+    def test_orphan_replay(self):
+        orphan = self.write_orphan("journal-1.log",
+                                   '{"n": "skipped"}\n{"n": 1}\n{"n": 2}\n')
+        with open(orphan + ".offset", "wb") as f:
+            f.write(str(len('{"n": "skipped"}\n')))
+
+        self.make_journal().append({"n": 3})
+
+        wait_for(lambda: not os.path.exists(orphan))
+        wait_for(lambda: len(self.submitted) == 3)
+        assert not os.path.exists(orphan + ".offset")
+        assert sorted(e["n"] for e in self.submitted) == [1, 2, 3]
+
+    def test_orphan_replay_under_load(self):
+        j = self.make_journal()
+        j.append({"n": 0})
+        orphan = self.write_orphan("journal-1.log", '{"n": "orphan"}\n')
+
+        # keep our own journal busy; the orphan must still be picked up
+        for i in range(1, 30):
+            j.append({"n": i})
+            time.sleep(0.01)
+
+        wait_for(lambda: not os.path.exists(orphan), timeout=1)
+        assert {"n": "orphan"} in self.submitted
+
+    def test_torn_last_line(self):
+        orphan = self.write_orphan("journal-1.log", '{"n": 1}\n{"n": 2')
+        self.make_journal().append({"n": 3})
+
+        wait_for(lambda: not os.path.exists(orphan))
+        wait_for(lambda: len(self.submitted) == 2)
+        assert sorted(e["n"] for e in self.submitted) == [1, 3]
+
+    def test_start_race(self):
+        real_fcntl = journal.fcntl
+        filename = os.path.join(self.directory,
+                                "journal-{0}.log".format(os.getpid()))
+        raced = []
+
+        class RacingFcntl(object):
+            LOCK_EX = real_fcntl.LOCK_EX
+            LOCK_NB = real_fcntl.LOCK_NB
+
+            def flock(self, fd, operation):
+                if not raced and operation == self.LOCK_EX:
+                    # Another process' orphan drainer gets there first
+                    raced.append(True)
+                    os.unlink(filename)
+                real_fcntl.flock(fd, operation)
+
+        journal.fcntl = RacingFcntl()
+        try:
+            j = self.make_journal()
+            j.append({"n": 1})
+        finally:
+            journal.fcntl = real_fcntl
+
+        assert raced
+        wait_for(lambda: self.submitted == [{"n": 1}])
+        assert os.path.exists(filename)
+
+    def test_retry(self):
+        failures = [Exception("first"), Exception("second")]
+        def submit(entry):
+            if failures:
+                raise failures.pop()
+            self.submitted.append(entry)
+
+        j = journal.Journal(self.directory, submit, fsync_interval=0.01,
+                            max_retry_delay=0.01)
+        j.append({"n": 1})
+        j.append({"n": 2})
+        wait_for(lambda: len(self.submitted) == 2)
+        assert self.submitted == [{"n": 1}, {"n": 2}]
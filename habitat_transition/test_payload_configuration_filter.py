@@ -0,0 +1,30 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the couch_to_xml publisher's changes filter
+"""
+
+from . import couch_to_xml
+
+def test_payload_configuration_filter():
+    fil = couch_to_xml.payload_configuration_filter
+
+    assert fil({"type": "payload_configuration"}, {})
+    assert fil({"_deleted": True}, {})
+    assert not fil({"type": "payload_telemetry"}, {})
+    assert not fil({}, {})
@@ -0,0 +1,36 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the fixed window rate limiter
+"""
+
+from . import caches, ratelimit
+
+def test_fixed_window():
+    window = ratelimit.FixedWindow(caches.LRUCache(), "cs/", limit=3,
+                                   period=10)
+
+    assert [window.allow("A", now=100) for i in range(4)] == \
+            [True, True, True, False]
+    # other keys have their own counter
+    assert window.allow("B", now=100)
+
+    assert not window.allow("A", now=109.9)
+    # a new window
+    assert [window.allow("A", now=110) for i in range(4)] == \
+            [True, True, True, False]
@@ -0,0 +1,108 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests forwarding to several trackers, and debouncing, in SpaceNearUs
+"""
+
+import time
+
+from . import spacenearus
+
+class FakeSink(object):
+    def __init__(self, name="fake"):
+        self.name = name
+        self.uploads = []
+    def put(self, params):
+        self.uploads.append(params)
+
+def make_daemon(**settings):
+    settings.setdefault("trackers", ["http://example.com/track.php?{0}"])
+    config = {"couch_uri": "http://localhost:5984", "couch_db": "habitat",
+              "spacenearus": settings}
+    return spacenearus.SpaceNearUs(config, "spacenearus")
+
+def payload_doc(receivers):
+    data = {"_parsed": {}, "payload": "TEST", "sentence_id": 1,
+            "time": "12:00:00", "latitude": 52.0, "longitude": 0.0,
+            "altitude": 1000}
+    return {"_id": "doc", "type": "payload_telemetry", "data": data,
+            "receivers": dict((callsign, {}) for callsign in receivers)}
+
+def callsigns(sink):
+    return sorted(params["callsign"] for params in sink.uploads)
+
+def test_default_names():
+    a = spacenearus.TrackerSink("http://example.com/tracker/track.php?{0}")
+    b = spacenearus.TrackerSink("http://example.com/mirror/track.php?{0}")
+    assert a.name == "example_com_tracker_track_php"
+    assert a.name != b.name
+
+def test_duplicate_names():
+    try:
+        make_daemon(trackers=["http://example.com/track.php?{0}",
+                              {"url": "http://example.com/track.php?{0}"}])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("duplicate names accepted")
+
+def test_queue_full_isolation():
+    # not started, so nothing is taken off the queues
+    full = spacenearus.TrackerSink("http://a.example.com/?{0}", queue_size=1)
+    roomy = spacenearus.TrackerSink("http://b.example.com/?{0}")
+    daemon = make_daemon()
+    daemon.sinks = [full, roomy]
+
+    for i in range(3):
+        daemon._queue_upload({"n": i})
+
+    assert full.upload_queue.qsize() == 1
+    assert roomy.upload_queue.qsize() == 3
+
+def test_debounce_collapses_revisions():
+    daemon = make_daemon(debounce=2)
+    sink = FakeSink()
+    daemon.sinks = [sink]
+
+    daemon._debounce(payload_doc(["A"]))
+    daemon._debounce(payload_doc(["A", "B"]))
+    daemon._debounce(payload_doc(["A", "B", "C"]))
+    daemon._debounce_flush(time.time())
+    assert sink.uploads == []
+
+    daemon._debounce_flush(time.time() + 3)
+    assert callsigns(sink) == ["A", "B", "C"]
+
+def test_debounce_first_immediately():
+    daemon = make_daemon(debounce=2, debounce_first_immediately=True)
+    sink = FakeSink()
+    daemon.sinks = [sink]
+
+    daemon._debounce(payload_doc(["A"]))
+    assert callsigns(sink) == ["A"]
+
+    daemon._debounce(payload_doc(["A", "B"]))
+    daemon._debounce(payload_doc(["A", "B", "C"]))
+    assert callsigns(sink) == ["A"]
+
+    daemon._debounce_flush(time.time() + 3)
+    assert callsigns(sink) == ["A", "B", "C"]
+
+    # nothing left waiting
+    daemon._debounce_flush(time.time() + 6)
+    assert len(sink.uploads) == 3
@@ -0,0 +1,43 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests chase car track thinning
+"""
+
+from . import thinning
+
+def test_thinner():
+    t = thinning.Thinner(min_distance=100, min_interval=10, max_interval=60)
+
+    assert t.consider(u"CAR", 52.0, 0.0, 1000)
+    # too soon
+    assert not t.consider(u"CAR", 52.01, 0.0, 1005)
+    # far enough, late enough
+    assert t.consider(u"CAR", 52.01, 0.0, 1010)
+    # hasn't moved
+    assert not t.consider(u"CAR", 52.01, 0.0, 1030)
+    # other callsigns are separate
+    assert t.consider(u"OTHER CAR", 52.01, 0.0, 1030)
+    # parked for max_interval
+    assert t.consider(u"CAR", 52.01, 0.0, 1070)
+
+def test_keep():
+    t = thinning.Thinner(min_distance=100, min_interval=10, max_interval=60)
+    assert t.consider(u"CAR", 52.0, 0.0, 1000)
+    t.keep(u"CAR", 52.0, 0.0, 1050)
+    assert not t.consider(u"CAR", 52.0, 0.0, 1100)
@@ -0,0 +1,155 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests the XML importer's deduplication and batch upload
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+from couchdbkit.exceptions import BulkSaveError
+
+from . import xml_to_couch
+
+PAYLOAD_XML = """<?xml version="1.0"?>
+<payload>
+    <sentence>
+        <callsign>{0}</callsign>
+        <field><dbfield>callsign</dbfield><datatype>char</datatype></field>
+        <field><dbfield>latitude</dbfield><datatype>decimal</datatype></field>
+    </sentence>
+</payload>
+"""
+
+class FakeDB(object):
+    """all_docs and bulk_save, with canned existing docs and save errors"""
+
+    def __init__(self, existing=None, errors=None):
+        self.existing = existing or {}
+        self.errors = errors or {}
+        self.saved = []
+
+    def all_docs(self, keys):
+        rows = []
+        for key in keys:
+            if key in self.existing:
+                rows.append({"id": key, "key": key,
+                             "value": self.existing[key]})
+            else:
+                rows.append({"key": key, "error": "not_found"})
+        return rows
+
+    def bulk_save(self, docs):
+        results = []
+        for doc in docs:
+            if doc["_id"] in self.errors:
+                results.append({"id": doc["_id"],
+                                "error": self.errors[doc["_id"]],
+                                "reason": "nope"})
+            else:
+                self.saved.append(doc)
+                self.existing[doc["_id"]] = {"rev": "1-abc"}
+                results.append({"id": doc["_id"], "rev": "1-abc"})
+
+        errors = [r for r in results if "error" in r]
+        if errors:
+            raise BulkSaveError(errors, results)
+        return results
+
+def empty_summary():
+    return {"uploaded": [], "existing": [], "duplicates": [], "failed": []}
+
+class TestImport(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, callsign, mtime):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as f:
+            f.write(PAYLOAD_XML.format(callsign))
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_parse_xml(self):
+        doc = xml_to_couch.parse_xml(self.write("a.xml", "TEST", 1000))
+        assert doc["_id"] == "imported_xml_TEST"
+        assert doc["name"] == "a"
+        assert doc["payloads"]["TEST"]["sentence"]["fields"] == \
+                [{"name": "latitude", "type": "stdtelem.coordinate",
+                  "format": "dd.dddd"}]
+
+    def test_import_paths(self):
+        old = self.write("old.xml", "DUP", 1000)
+        new = self.write("new.xml", "DUP", 2000)
+        other = self.write("other.xml", "OTHER", 1000)
+        bad = os.path.join(self.directory, "bad.xml")
+        with open(bad, "w") as f:
+            f.write("<payload>")
+
+        db = FakeDB()
+        server = xml_to_couch.couchdbkit.Server
+        xml_to_couch.couchdbkit.Server = lambda uri: {"habitat": db}
+        try:
+            summary = xml_to_couch.import_paths(
+                    xml_to_couch.find_files(self.directory),
+                    "http://localhost:5984", "habitat", processes=1)
+            again = xml_to_couch.import_paths([new], "http://localhost:5984",
+                                              "habitat", processes=1)
+        finally:
+            xml_to_couch.couchdbkit.Server = server
+
+        assert sorted(summary["uploaded"]) == [new, other]
+        assert summary["duplicates"] == [old]
+        assert [filename for (filename, error) in summary["failed"]] == [bad]
+        assert sorted(doc["name"] for doc in db.saved) == ["new", "other"]
+
+        # re-running skips what is already there
+        assert again["existing"] == [new]
+        assert len(db.saved) == 2
+
+    def test_upload_batch(self):
+        db = FakeDB(existing={"imported_xml_A": {"rev": "1-a"},
+                              "imported_xml_B": {"rev": "2-b",
+                                                 "deleted": True}},
+                    errors={"imported_xml_C": "conflict",
+                            "imported_xml_D": "forbidden"})
+        batch = [(1000, callsign + ".xml", {"_id": "imported_xml_" + callsign})
+                 for callsign in "ABCDE"]
+        summary = empty_summary()
+
+        xml_to_couch._upload_batch(db, batch, summary)
+
+        # deleted docs may be replaced
+        assert summary["uploaded"] == ["B.xml", "E.xml"]
+        # a conflict means somebody else uploaded it first
+        assert summary["existing"] == ["A.xml", "C.xml"]
+        assert summary["failed"] == [("D.xml", "nope")]
+        assert [doc["_id"] for doc in db.saved] == \
+                ["imported_xml_B", "imported_xml_E"]
+
+    def test_upload_batch_all_existing(self):
+        db = FakeDB(existing={"imported_xml_A": {"rev": "1-a"}})
+        summary = empty_summary()
+        xml_to_couch._upload_batch(db, [(1000, "A.xml",
+                                         {"_id": "imported_xml_A"})], summary)
+        assert summary["existing"] == ["A.xml"]
+        assert db.saved == []
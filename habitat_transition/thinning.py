@@ -0,0 +1,78 @@
+# Copyright 2026 (C) agent
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Thinning of chase car tracks, so that a car posting its position every few
+seconds doesn't produce a doc and a tracker upload for each one.
+"""
+
+import urllib
+
+from .geo import haversine
+from .caches import LRUCache
+
+__all__ = ["Thinner"]
+
+
+class Thinner(object):
+    """
+    Decides which points of each callsign's track to keep.
+
+    A point is kept if it is at least *min_distance* metres and
+    *min_interval* seconds on from the last kept point, or if *max_interval*
+    seconds have passed since the last kept point (so a parked car still
+    shows up now and again).
+
+    The last kept point is stored in *cache*, a werkzeug cache which may be
+    shared between processes; by default a per-process
+    :class:`~habitat_transition.caches.LRUCache`.
+    """
+
+    def __init__(self, min_distance=0, min_interval=0, max_interval=300,
+                 cache=None, prefix="thin/"):
+        self.min_distance = min_distance
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cache = cache if cache is not None else LRUCache()
+        self.prefix = prefix
+
+    def _key(self, callsign):
+        return self.prefix + urllib.quote(callsign.encode("utf8"), safe="")
+
+    def consider(self, callsign, lat, lon, timestamp):
+        """Returns True, and records the point, if it should be kept"""
+        last = self.cache.get(self._key(callsign))
+
+        if last is not None:
+            (last_lat, last_lon, last_timestamp) = last
+            dt = timestamp - last_timestamp
+
+            if dt < self.max_interval:
+                if dt < self.min_interval:
+                    return False
+                if haversine(lat, lon, last_lat, last_lon) < self.min_distance:
+                    return False
+
+        self.keep(callsign, lat, lon, timestamp)
+        return True
+
+    def keep(self, callsign, lat, lon, timestamp):
+        """Record a point as kept, regardless of whether it should be"""
+        # Once max_interval has passed the next point is kept anyway, so the
+        # entry may as well expire.
+        self.cache.set(self._key(callsign), (lat, lon, timestamp),
+                       timeout=int(self.max_interval) + 1)
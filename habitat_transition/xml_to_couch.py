@@ -19,73 +19,27 @@
 """
 Read in an XML payload configuration doc and upload it to CouchDB as a sandbox
 flight document, used to aid transition from the old dl system to habitat.
+
+Given a directory or a glob instead of a file, parse every XML file in it in
+parallel and upload the docs in batches. Files are deduplicated by callsign
+(the most recently modified wins).
+
+In either mode each doc gets an _id derived from its callsign, so re-running
+an import skips payloads that are already there.
 """
 
 import sys
-if len(sys.argv) != 4:
-    n = sys.argv[0]
-    print "Usage: {0} <payload xml file> <couch URI> <couch db>".format(n)
-    sys.exit(1)
-
-import couchdbkit
+import os
 import os.path
+import glob
 import time
 import pprint
+import multiprocessing
+import couchdbkit
+from couchdbkit.exceptions import BulkSaveError, ResourceConflict
 import elementtree.ElementTree as ET
 from xml.parsers.expat import ExpatError
 
-try:
-    tree = ET.parse(sys.argv[1])
-except (IOError, ExpatError, AttributeError) as e:
-    print "Could not parse XML: {0}".format(e)
-    sys.exit(1)
-
-callsign = tree.findtext("sentence/callsign")
-if not callsign:
-    print "Could not find a callsign in the document."
-    sys.exit(1)
-
-frequency = tree.findtext("frequency", default="434.075.000")
-frequency = '.'.join(frequency.split('.')[0:2])
-mode = tree.findtext("mode", default="usb").upper()
-shift = int(tree.findtext("txtype/rtty/shift", default="300"))
-encoding = tree.findtext("txtype/rtty/coding", default="ascii-8")
-baud = int(tree.findtext("txtype/rtty/baud", default="50"))
-parity = tree.findtext("txtype/rtty/parity", default="none")
-stop = float(tree.findtext("txtype/rtty/stop", default="1"))
-
-doc = {
-    "type": "flight",
-    "name": os.path.basename(sys.argv[1]).split(".")[0],
-    "start": int(time.time()),
-    "end": "sandbox",
-    "metadata": {
-        "imported_from_xml": True
-    },
-    "payloads": {
-        callsign : {
-            "radio": {
-                "frequency": frequency,
-                "mode": mode
-            },
-            "telemetry": {
-                "modulation": "rtty",
-                "shift": shift,
-                "encoding": encoding,
-                "baud": baud,
-                "parity": parity,
-                "stop": stop
-            },
-            "sentence": {
-                "protocol": "UKHAS",
-                "checksum": "crc16-ccitt",
-                "payload": callsign,
-                "fields": []
-            }
-        }
-    }
-}
-
 type_map = {
     "fixed": "base.ascii_float",
     "char": "base.ascii_string",
@@ -96,33 +50,222 @@ type_map = {
     "custom_data": "base.string"
 }
 
-server = couchdbkit.Server(sys.argv[2])
-db = server[sys.argv[3]]
+def main():
+    if len(sys.argv) != 4:
+        n = sys.argv[0]
+        print "Usage: {0} <payload xml file|directory|glob> <couch URI> " \
+              "<couch db>".format(n)
+        sys.exit(1)
+
+    (path, couch_uri, couch_db) = sys.argv[1:]
+
+    if os.path.isfile(path):
+        try:
+            doc = parse_xml(path)
+        except ValueError as e:
+            print e
+            sys.exit(1)
 
-for field in tree.getiterator("field"):
-    if field.findtext("dbfield") == "callsign":
-        continue
+        server = couchdbkit.Server(couch_uri)
+        db = server[couch_db]
 
-    new_field = {
-        "name": field.findtext("dbfield"),
-        "type": type_map.get(field.findtext("datatype"), "base.ascii_string")
+        print "Saving document:"
+        pprint.pprint(doc)
+        try:
+            db.save_doc(doc)
+        except ResourceConflict:
+            print "Already present: {0}".format(doc["_id"])
+    else:
+        summary = import_paths(find_files(path), couch_uri, couch_db)
+        print_summary(summary)
+        if summary["failed"]:
+            sys.exit(1)
+
+def parse_xml(filename):
+    """Build a flight doc from an XML file, raising ValueError if we can't"""
+
+    try:
+        tree = ET.parse(filename)
+    except (IOError, ExpatError, AttributeError) as e:
+        raise ValueError("Could not parse XML: {0}".format(e))
+
+    callsign = tree.findtext("sentence/callsign")
+    if not callsign:
+        raise ValueError("Could not find a callsign in the document.")
+
+    frequency = tree.findtext("frequency", default="434.075.000")
+    frequency = '.'.join(frequency.split('.')[0:2])
+    mode = tree.findtext("mode", default="usb").upper()
+    shift = int(tree.findtext("txtype/rtty/shift", default="300"))
+    encoding = tree.findtext("txtype/rtty/coding", default="ascii-8")
+    baud = int(tree.findtext("txtype/rtty/baud", default="50"))
+    parity = tree.findtext("txtype/rtty/parity", default="none")
+    stop = float(tree.findtext("txtype/rtty/stop", default="1"))
+
+    doc = {
+        # Deterministic, so that importing a file twice doesn't create two
+        # flights
+        "_id": "imported_xml_" + callsign,
+        "type": "flight",
+        "name": os.path.basename(filename).split(".")[0],
+        "start": int(time.time()),
+        "end": "sandbox",
+        "metadata": {
+            "imported_from_xml": True
+        },
+        "payloads": {
+            callsign : {
+                "radio": {
+                    "frequency": frequency,
+                    "mode": mode
+                },
+                "telemetry": {
+                    "modulation": "rtty",
+                    "shift": shift,
+                    "encoding": encoding,
+                    "baud": baud,
+                    "parity": parity,
+                    "stop": stop
+                },
+                "sentence": {
+                    "protocol": "UKHAS",
+                    "checksum": "crc16-ccitt",
+                    "payload": callsign,
+                    "fields": []
+                }
+            }
+        }
     }
-    
-    if new_field["name"] == "cycle_count":
-        new_field["name"] = "count"
 
-    if field.findtext("dbfield") in ("latitude", "longitude"):
-        if field.findtext("format"):
-            new_field["format"] = field.findtext("format")
+    for field in tree.getiterator("field"):
+        if field.findtext("dbfield") == "callsign":
+            continue
+
+        new_field = {
+            "name": field.findtext("dbfield"),
+            "type": type_map.get(field.findtext("datatype"),
+                                 "base.ascii_string")
+        }
+
+        if new_field["name"] == "cycle_count":
+            new_field["name"] = "count"
+
+        if field.findtext("dbfield") in ("latitude", "longitude"):
+            if field.findtext("format"):
+                new_field["format"] = field.findtext("format")
 
-            if new_field["format"] == "dddmm.mm":
-                new_field["format"] = "ddmm.mm"
+                if new_field["format"] == "dddmm.mm":
+                    new_field["format"] = "ddmm.mm"
+            else:
+                new_field["format"] = "dd.dddd"
+            new_field["type"] = "stdtelem.coordinate"
+
+        doc["payloads"][callsign]["sentence"]["fields"].append(new_field)
+
+    return doc
+
+def find_files(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, "*.xml")
+    return sorted(glob.glob(path))
+
+def _parse_worker(filename):
+    # Runs in the pool: return errors rather than raising them so that one
+    # bad file doesn't take out the whole map().
+    try:
+        return (filename, os.path.getmtime(filename), parse_xml(filename),
+                None)
+    except Exception as e:
+        return (filename, None, None, str(e))
+
+def import_paths(filenames, couch_uri, couch_db, processes=None,
+                 batch_size=100):
+    """
+    Parse *filenames* in a process pool and bulk upload the resulting docs.
+
+    Returns a summary dict: "uploaded", "existing" and "duplicates" are lists
+    of filenames, "failed" is a list of (filename, error) tuples.
+    """
+
+    summary = {"uploaded": [], "existing": [], "duplicates": [], "failed": []}
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_parse_worker, filenames, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+    by_callsign = {}
+    for (filename, mtime, doc, error) in results:
+        if error is not None:
+            summary["failed"].append((filename, error))
+            continue
+
+        (callsign, ) = doc["payloads"].keys()
+
+        if callsign in by_callsign:
+            (other_mtime, other_filename, other_doc) = by_callsign[callsign]
+            if other_mtime >= mtime:
+                summary["duplicates"].append(filename)
+                continue
+            summary["duplicates"].append(other_filename)
+
+        by_callsign[callsign] = (mtime, filename, doc)
+
+    server = couchdbkit.Server(couch_uri)
+    db = server[couch_db]
+
+    pending = sorted(by_callsign.values())
+    for i in xrange(0, len(pending), batch_size):
+        _upload_batch(db, pending[i:i + batch_size], summary)
+
+    return summary
+
+def _upload_batch(db, batch, summary):
+    filenames = {}
+    for (mtime, filename, doc) in batch:
+        filenames[doc["_id"]] = filename
+
+    existing = set()
+    for row in db.all_docs(keys=filenames.keys()):
+        if "error" not in row and not row["value"].get("deleted"):
+            existing.add(row["id"])
+
+    docs = []
+    for (mtime, filename, doc) in batch:
+        if doc["_id"] in existing:
+            summary["existing"].append(filename)
         else:
-            new_field["format"] = "dd.dddd"
-        new_field["type"] = "stdtelem.coordinate"
+            docs.append(doc)
+
+    if not docs:
+        return
+
+    try:
+        results = db.bulk_save(docs)
+    except BulkSaveError as e:
+        results = e.results
+
+    for result in results:
+        filename = filenames[result["id"]]
+        if "error" not in result:
+            summary["uploaded"].append(filename)
+        elif result["error"] == "conflict":
+            # Somebody got there first
+            summary["existing"].append(filename)
+        else:
+            summary["failed"].append((filename, result.get("reason")))
+
+def print_summary(summary):
+    print "Uploaded {0}, already present {1}, duplicate callsigns {2}, " \
+          "failed {3}".format(len(summary["uploaded"]),
+                              len(summary["existing"]),
+                              len(summary["duplicates"]),
+                              len(summary["failed"]))
 
-    doc["payloads"][callsign]["sentence"]["fields"].append(new_field)
+    for (filename, error) in summary["failed"]:
+        print "Failed: {0}: {1}".format(filename, error)
 
-print "Saving document:"
-pprint.pprint(doc)
-db.save_doc(doc)
+if __name__ == "__main__":
+    main()